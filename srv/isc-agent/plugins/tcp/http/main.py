@@ -1,34 +1,48 @@
 import datetime
-import json
+import functools
 import logging
 import os
 import random
 import re
 from http import HTTPStatus
-from typing import Dict, Optional
+from typing import Callable, Dict, List, NamedTuple, Optional, Pattern, Tuple, Union
 
 import requests
-from jinja2 import Environment, BaseLoader
+from jinja2 import Environment, BaseLoader, Template
+from twisted.protocols import policies
 from twisted.web import server, resource
-from twisted.internet import endpoints, reactor, ssl, task
+from twisted.internet import defer, endpoints, interfaces, reactor, ssl, task, threads
 from twisted.web.http import Request
 
 import settings
-from plugins.tcp.http.models import Signature, prepare_database, RequestLog, read_db_and_log, hydrate_tables
+from plugins.tcp.http.models import (
+    Signature, prepare_database, RequestLog, read_db_and_log, download_honeypot_rules, load_honeypot_rules
+)
 from plugins.tcp.http.schemas import Condition
 from utils import get_auth
 
+bad_request_body = HTTPStatus.BAD_REQUEST.description.encode()
 condition_translator = {
     Condition.absent: lambda x, y: x not in y,
     Condition.contains: lambda x, y: x in y,
     Condition.equal: lambda x, y: x == y,
     Condition.regex: re.match,
 }
+default_flush_logs_rate = 0.25
 default_http_ports = [8000, 8080]
 default_https_ports = [8443]
+default_listen_backlog = 512
+default_max_logged_body_size = 4096
+default_network_timeout = 60
 default_submit_logs_rate = 300
+default_thread_pool_size = 4
 logger = logging.getLogger(__name__)
+missing_attribute = object()
+signature_cache_size = 4096
+template_cache_size = 512
 template_environment = Environment(loader=BaseLoader(), autoescape=True)
+pending_request_logs: List[RequestLog] = []
+winning_signatures: Dict[Tuple, Optional[Signature]] = {}
 
 
 def extract_request_attributes(request: Request) -> Dict:
@@ -36,7 +50,7 @@ def extract_request_attributes(request: Request) -> Dict:
         'args': request.args,
         'client_ip': request.getClientIP(),
         'cookies': {k.decode(): v.decode() for k, v in request.received_cookies.items()},
-        'headers': {k.decode(): v.decode() for k, v in request.getAllHeaders().items()},
+        'headers': {k.decode().lower(): v[-1].decode() for k, v in request.requestHeaders.getAllRawHeaders()},
         'method': request.method.decode(),
         'password': request.getPassword().decode(),
         'path': request.path.decode(),
@@ -46,48 +60,273 @@ def extract_request_attributes(request: Request) -> Dict:
     }
 
 
+@functools.lru_cache(maxsize=template_cache_size)
+def get_template(source: str) -> Template:
+    return template_environment.from_string(source)
+
+
+@functools.lru_cache(maxsize=template_cache_size)
+def get_static_bytes(source: str) -> bytes:
+    return get_template(source).render().encode()
+
+
+def render_bytes(source: str, variables: Dict) -> bytes:
+    if '{' not in source:
+        return get_static_bytes(source)
+    return get_template(source).render(variables).encode()
+
+
+@functools.lru_cache(maxsize=template_cache_size)
+def get_static_headers(headers: Tuple[Tuple[str, str], ...]) -> Optional[Tuple[Tuple[bytes, bytes], ...]]:
+    if any('{' in name or '{' in value for name, value in headers):
+        return None
+    return tuple((get_static_bytes(name), get_static_bytes(value)) for name, value in headers)
+
+
+def render_headers(headers: Tuple[Tuple[str, str], ...], variables: Dict) -> Tuple[Tuple[bytes, bytes], ...]:
+    static_headers = get_static_headers(headers)
+    if static_headers is not None:
+        return static_headers
+    return tuple((render_bytes(name, variables), render_bytes(value, variables)) for name, value in headers)
+
+
+class CompiledResponse(NamedTuple):
+    id: int
+    status_code: int
+    body: str
+    headers: Tuple[Tuple[str, str], ...]
+
+
+class CompiledRule(NamedTuple):
+    attribute: str
+    key: Optional[str]
+    value: Union[str, Pattern]
+    condition_function: Callable
+    score: int
+    required: bool
+
+
+class RuleLookup(NamedTuple):
+    attribute: str
+    keys: Tuple[str, ...]
+    members: Tuple[Union[str, Pattern], ...]
+
+
+def match_pattern(pattern: Pattern, attribute: str):
+    return pattern.match(attribute)
+
+
+def never_match(_value, _attribute) -> bool:
+    return False
+
+
+def compile_rules(rules: List[Dict]) -> Tuple[CompiledRule, ...]:
+    compiled_rules = []
+    for rule in rules:
+        if rule['condition'] not in condition_translator:
+            continue
+        if ":" in rule['value']:
+            key, value = rule['value'].split(':', 1)
+        else:
+            key, value = None, rule['value']
+        condition_function = condition_translator[rule['condition']]
+        if rule['condition'] == Condition.regex:
+            try:
+                value = re.compile(value)
+                condition_function = match_pattern
+            except re.error as err:
+                logger.warning('Rule regex %r failed to compile: %s', value, err)
+                condition_function = never_match
+        compiled_rules.append(CompiledRule(
+            rule['attribute'], key, value, condition_function, rule['score'], rule['required']
+        ))
+    return tuple(compiled_rules)
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+@functools.lru_cache(maxsize=1)
+def get_signatures() -> List[Signature]:
+    return settings.DATABASE_SESSION.query(Signature).order_by(Signature.max_score.desc()).all()
+
+
+@functools.lru_cache(maxsize=1)
+def get_signature_rules() -> Dict[int, Tuple[CompiledRule, ...]]:
+    return {signature.id: compile_rules(signature.rules) for signature in get_signatures()}
+
+
+@functools.lru_cache(maxsize=1)
+def get_signature_responses() -> Dict[int, Tuple[CompiledResponse, ...]]:
+    return {
+        signature.id: tuple(
+            CompiledResponse(response.id, response.status_code, response.body, tuple(response.headers.items()))
+            for response in signature.responses
+        )
+        for signature in get_signatures()
+    }
+
+
+@functools.lru_cache(maxsize=1)
+def get_rule_lookups() -> Tuple[RuleLookup, ...]:
+    keys = {}
+    members = {}
+    for rules in get_signature_rules().values():
+        for rule in rules:
+            keys.setdefault(rule.attribute, set())
+            members.setdefault(rule.attribute, set())
+            if rule.key is None:
+                members[rule.attribute].add(rule.value)
+            else:
+                keys[rule.attribute].add(rule.key)
+    return tuple(
+        RuleLookup(attribute, tuple(sorted(keys[attribute])), tuple(sorted(members[attribute], key=str)))
+        for attribute in sorted(keys)
+    )
+
+
+def get_required_method(signature: Signature) -> Optional[str]:
+    for rule in signature.rules:
+        if rule['attribute'] == 'method' and rule['condition'] == Condition.equal and rule.get('required'):
+            return rule['value']
+    return None
+
+
+class SignatureColumns(NamedTuple):
+    max_scores: Tuple[int, ...]
+    base_scores: Tuple[int, ...]
+    rules: Tuple[Tuple[CompiledRule, ...], ...]
+    signatures: Tuple[Signature, ...]
+
+
+def is_method_rule(rule: CompiledRule, method: Optional[str]) -> bool:
+    return (
+        rule.attribute == 'method' and rule.key is None and rule.required and rule.value == method
+        and rule.condition_function is condition_translator[Condition.equal]
+    )
+
+
+def build_signature_columns(signatures: List[Signature], method: Optional[str]) -> SignatureColumns:
+    # Each candidate already passed its required method rule, so that rule is folded into a base score
+    signature_rules = get_signature_rules()
+    base_scores = []
+    rules = []
+    for signature in signatures:
+        base_scores.append(sum(rule.score for rule in signature_rules[signature.id] if is_method_rule(rule, method)))
+        rules.append(tuple(rule for rule in signature_rules[signature.id] if not is_method_rule(rule, method)))
+    return SignatureColumns(
+        tuple(10000 if signature.max_score is None else signature.max_score for signature in signatures),
+        tuple(base_scores),
+        tuple(rules),
+        tuple(signatures),
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def get_signatures_by_method() -> Dict[Optional[str], SignatureColumns]:
+    signatures = get_signatures()
+    required_methods = [get_required_method(signature) for signature in signatures]
+    return {
+        method: build_signature_columns([
+            signature for signature, required_method in zip(signatures, required_methods)
+            if required_method in (None, method)
+        ], method)
+        for method in set(required_methods) | {None}
+    }
+
+
+def get_candidate_signatures(method: Optional[str]) -> SignatureColumns:
+    signatures_by_method = get_signatures_by_method()
+    return signatures_by_method.get(method, signatures_by_method[None])
+
+
+def get_signature_cache_key(request_attributes: Dict) -> Tuple:
+    # Against a mapping a key-less rule can only ever test key membership, so that is all the key records for it
+    cache_key = []
+    for attribute, keys, members in get_rule_lookups():
+        value = request_attributes.get(attribute, missing_attribute)
+        if isinstance(value, dict):
+            cache_key.append(tuple(freeze(value.get(key, missing_attribute)) for key in keys))
+            cache_key.append(tuple(member in value for member in members))
+        else:
+            cache_key.append(freeze(value))
+    return tuple(cache_key)
+
+
+def reload_signatures():
+    """
+    forget cached signatures and scoring results, must be called whenever the signature table changes
+    """
+    get_signatures.cache_clear()
+    get_signature_rules.cache_clear()
+    get_signature_responses.cache_clear()
+    get_rule_lookups.cache_clear()
+    get_signatures_by_method.cache_clear()
+    winning_signatures.clear()
+
+
 def get_winning_signature(request_attributes: Dict) -> Optional[Signature]:
+    cache_key = get_signature_cache_key(request_attributes)
+    if cache_key in winning_signatures:
+        return winning_signatures[cache_key]
+    winning_signature = score_signatures(request_attributes)
+    if len(winning_signatures) >= signature_cache_size:
+        winning_signatures.pop(next(iter(winning_signatures)))
+    winning_signatures[cache_key] = winning_signature
+    return winning_signature
+
+
+def score_signatures(request_attributes: Dict) -> Optional[Signature]:
     top_score = 0
     winning_signature = None
-    signatures = settings.DATABASE_SESSION.query(Signature).order_by(Signature.max_score.desc()).all()
-    for signature in signatures:
-        if signature.max_score is None:
-            signature.max_score = 10000
-        if top_score >= signature.max_score:
+    candidates = get_candidate_signatures(request_attributes.get('method'))
+    for max_score, base_score, rules, signature in zip(*candidates):
+        if top_score >= max_score:
             break
-        score = get_signature_score(signature.rules, request_attributes)
+        score = get_signature_score(rules, request_attributes, base_score)
         if score and score >= top_score:
             top_score = score
             winning_signature = signature
     return winning_signature
 
 
-def get_signature_score(rules, attributes):
-    score = 0
+def get_signature_score(rules: Tuple[CompiledRule, ...], attributes: Dict, score: int = 0) -> int:
     for rule in rules:
-        if rule['attribute'] not in attributes or rule['condition'] not in condition_translator:
+        if rule.attribute not in attributes:
             continue
 
-        if ":" in rule['value']:
-            key, value = rule['value'].split(':')
-            attribute = attributes[rule['attribute']][key]
+        if rule.key is None:
+            attribute = attributes[rule.attribute]
         else:
-            value = rule['value']
-            attribute = attributes[rule['attribute']]
+            attribute = attributes[rule.attribute][rule.key]
 
-        condition_function = condition_translator[rule['condition']]
-        if condition_function(value, attribute):
-            score += rule['score']
-        elif rule['required']:
+        if rule.condition_function(rule.value, attribute):
+            score += rule.score
+        elif rule.required:
             score = 0
             break
     return score
 
 
-def log_request(request_attributes: Dict, signature_id: Optional[int] = None, response_id: Optional[int] = None):
+def read_request_body(request: Request, max_size: int = default_max_logged_body_size) -> str:
+    content = getattr(request, 'content', None)
+    if content is None:
+        return ''
+    content.seek(0)
+    return content.read(max_size).decode(errors='replace')
+
+
+def log_request(request_attributes: Dict, post_data: str = '', signature_id: Optional[int] = None,
+                response_id: Optional[int] = None):
     request_log = RequestLog(
+        time=datetime.datetime.now(),
         client_ip=request_attributes['client_ip'],
-        # data={'post_data': request_attributes['args']},  TODO - convert keys from bytes to strings
+        data={'post_data': post_data},
         headers=str(request_attributes['headers']),
         method=request_attributes['method'],
         path=request_attributes['path'],
@@ -96,94 +335,149 @@ def log_request(request_attributes: Dict, signature_id: Optional[int] = None, re
         target_ip=request_attributes['target_ip'],
         version=request_attributes['version'],
     )
-    settings.DATABASE_SESSION.add(request_log)
+    pending_request_logs.append(request_log)
+
+
+def flush_request_logs():
+    if not pending_request_logs:
+        return
+    request_logs = list(pending_request_logs)
+    pending_request_logs.clear()
+    settings.DATABASE_SESSION.add_all(request_logs)
     settings.DATABASE_SESSION.flush()
-    read_db_and_log()
+    read_db_and_log(request_logs=request_logs)
+
+
+def post_logs(logs: List[Dict]):
+    # Runs in the reactor thread pool, so it must not touch the database session
+    auth = get_auth()
+    resp = requests.post(
+        f"{settings.DSHIELD_URL}/submitapi/",
+        json={
+            "type": "webhoneypot",
+            "logs": logs,
+            "authheader": auth
+        },
+        headers={
+            'content-type': 'application/json',
+            'User-Agent': 'DShield PyLib 0.1',
+            'X-ISC-Authorization': auth,
+            'X-ISC-LogType': "httprequest"
+        },
+        timeout=default_network_timeout
+    )
+    if not resp.ok:
+        logger.error(
+            "Failed to submit logs: (status code: %s) %s",
+            resp.status_code,
+            resp.text
+        )
+    else:
+        logger.info("succesfully submitted %s logs", len(logs))
+
 
+def reload_honeypot_rules(honeypot_rules: Optional[Dict]):
+    load_honeypot_rules(honeypot_rules)
+    reload_signatures()
 
-def submit_logs():
-    # Submit logs
+
+def submit_logs() -> defer.Deferred:
+    flush_request_logs()
     request_logs = settings.DATABASE_SESSION.query(RequestLog).all()
     logger.debug(request_logs)
     if request_logs:
-        auth = get_auth()
-        resp = requests.post(
-            f"{settings.DSHIELD_URL}/submitapi/",
-            json={
-                "type": "webhoneypot",
-                "logs": [rl.format_log_for_submission() for rl in request_logs],
-                "authheader": auth
-            },
-            headers={
-                'content-type': 'application/json',
-                'User-Agent': 'DShield PyLib 0.1',
-                'X-ISC-Authorization': auth,
-                'X-ISC-LogType': "httprequest"
-            }
-        )
-        if not resp.ok:
-            logger.error(
-                f"Failed to submit logs: (status code: %s) %s",
-                resp.status_code,
-                resp.text
-            )
-        else:
-            logger.info(f"succesfully submitted logs {request_logs}")
-            
-    hydrate_tables()
+        logs = [rl.format_log_for_submission() for rl in request_logs]
+        settings.DATABASE_SESSION.query(RequestLog).filter(
+            RequestLog.id.in_([rl.id for rl in request_logs])).delete(synchronize_session='fetch')
+        deferred = threads.deferToThread(post_logs, logs)
+    else:
+        deferred = defer.succeed(None)
+    deferred.addErrback(lambda failure: logger.error('Failed to submit logs: %s', failure.getErrorMessage()))
+    deferred.addCallback(lambda _: threads.deferToThread(download_honeypot_rules))
+    deferred.addErrback(lambda failure: logger.error('Failed to download rules: %s', failure.getErrorMessage()))
+    deferred.addCallback(reload_honeypot_rules)
+    return deferred
 
 
 class HTTP(resource.Resource):
     isLeaf = True
 
+    def __init__(self, max_logged_body_size: int = default_max_logged_body_size):
+        super().__init__()
+        self.max_logged_body_size = max_logged_body_size
+
     def render(self, request: Request):
         request_attributes = extract_request_attributes(request)
+        post_data = read_request_body(request, self.max_logged_body_size)
         signature = get_winning_signature(request_attributes)
 
         if signature:
-            response = random.choice(signature.responses)  # nosec
+            response = random.choice(get_signature_responses()[signature.id])  # nosec
             request.setResponseCode(response.status_code)
 
             template_variables = {
                 **request_attributes,
                 'datetime': datetime.datetime.now()
             }
-            body = template_environment.from_string(response.body).render(template_variables).encode()
-            headers = json.loads(
-                template_environment.from_string(
-                    json.dumps(response.headers)
-                ).render(template_variables)
-            )
-            for name, value in headers.items():
+            body = render_bytes(response.body, template_variables)
+            headers = render_headers(response.headers, template_variables)
+            for name, value in headers:
                 request.responseHeaders.setRawHeaders(name, [value])
-            request.responseHeaders.setRawHeaders('Content-Length', [str(len(body))])
+            request.responseHeaders.setRawHeaders(b'Content-Length', [b'%d' % len(body)])
             request.write(body)
-            log_request(request_attributes, signature.id, response.id)
+            request.finish()
+            log_request(request_attributes, post_data, signature.id, response.id)
         else:
             request.setResponseCode(HTTPStatus.BAD_REQUEST)
-            body = HTTPStatus.BAD_REQUEST.description.encode()
-            request.responseHeaders.setRawHeaders('Content-Length', [str(len(body))])
-            request.write(body)
-            log_request(request_attributes)
-        return b''
+            request.responseHeaders.setRawHeaders(b'Content-Length', [b'%d' % len(bad_request_body)])
+            request.write(bad_request_body)
+            request.finish()
+            log_request(request_attributes, post_data)
+        return server.NOT_DONE_YET
+
+
+class NoDelayProtocol(policies.ProtocolWrapper):
+    """
+    Protocol wrapper that turns off Nagle's algorithm on TCP transports
+    """
+
+    def makeConnection(self, transport):
+        if interfaces.ITCPTransport.providedBy(transport):
+            transport.setTcpNoDelay(True)
+        super().makeConnection(transport)
+
+
+class NoDelayFactory(policies.WrappingFactory):
+    protocol = NoDelayProtocol
 
 
 def handler(**kwargs):
     prepare_database()
+    reload_signatures()
+
+    reactor.suggestThreadPoolSize(kwargs.get('thread_pool_size', default_thread_pool_size))
 
     submit_logs_task = task.LoopingCall(submit_logs)
     submit_logs_task.start(kwargs.get('submit_logs_rate', default_submit_logs_rate), now=True)
 
+    flush_logs_task = task.LoopingCall(flush_request_logs)
+    flush_logs_task.start(kwargs.get('flush_logs_rate', default_flush_logs_rate), now=False)
+    reactor.addSystemEventTrigger('before', 'shutdown', flush_request_logs)
+
     http_ports = kwargs.get('http_ports', default_http_ports)
     https_ports = kwargs.get('https_ports', default_https_ports)
+    backlog = kwargs.get('listen_backlog', default_listen_backlog)
+    max_logged_body_size = kwargs.get('max_logged_body_size', default_max_logged_body_size)
 
     for port in http_ports:
         logger.info(port)
-        endpoints.TCP4ServerEndpoint(reactor, port).listen(server.Site(HTTP()))
+        endpoint = endpoints.TCP4ServerEndpoint(reactor, port, backlog=backlog)
+        endpoint.listen(NoDelayFactory(server.Site(HTTP(max_logged_body_size))))
 
     if os.path.exists(settings.PRIVATE_KEY) and os.path.exists(settings.CERT_KEY):
         ssl_context = ssl.DefaultOpenSSLContextFactory(settings.PRIVATE_KEY, settings.CERT_KEY)
         for port in https_ports:
-            endpoints.SSL4ServerEndpoint(reactor, port, ssl_context).listen(server.Site(HTTP()))
+            endpoint = endpoints.SSL4ServerEndpoint(reactor, port, ssl_context, backlog=backlog)
+            endpoint.listen(NoDelayFactory(server.Site(HTTP(max_logged_body_size))))
     else:
-        logger.warning(f'Will not start https because cert or key file not found at {settings.CERT_KEY}')
+        logger.warning('Will not start https because cert or key file not found at %s', settings.CERT_KEY)
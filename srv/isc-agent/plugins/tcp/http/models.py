@@ -15,6 +15,7 @@ import settings
 from plugins.tcp.http import schemas
 from utils import BaseModel
 
+download_timeout = 60
 logger = logging.getLogger(__name__)
 logs = []
 
@@ -26,7 +27,7 @@ class RequestLog(BaseModel):
     __tablename__ = 'request_log'
 
     id = Column(Integer, primary_key=True)
-    time = Column(DateTime, default=datetime.datetime.now())
+    time = Column(DateTime, default=datetime.datetime.now)
     client_ip = Column(Text)
     data = Column(JSON)
     headers = Column(Text)
@@ -62,7 +63,7 @@ class RequestLog(BaseModel):
                 "useragent": headers.get("user-agent")
             }
         except json.decoder.JSONDecodeError:
-            logger.warning('JSON Decode Failed for '+self.headers)
+            logger.warning('JSON Decode Failed for %s', self.headers)
             return ''
 
 
@@ -140,28 +141,37 @@ def create_tables():
     settings.DATABASE_MAPPER_REGISTRY.metadata.create_all(settings.DATABASE_ENGINE)
 
 
-def hydrate_tables():
+def download_honeypot_rules():
     """
-    potentially insert data into the tables we just created
+    fetch the current responses and signatures from DShield, None if they could not be downloaded
     """
-    # Empty tables
-    settings.DATABASE_SESSION.query(RequestLog).delete()
-    settings.DATABASE_SESSION.query(SignatureResponse).delete()
-    settings.DATABASE_SESSION.query(Signature).delete()
-    settings.DATABASE_SESSION.query(Response).delete()
-
     resp = requests.get(
         f'{settings.DSHIELD_URL}/api/honeypotrules/',
+        timeout=download_timeout,
         verify=True
     )
 
     if not resp.ok:
         logger.exception("HTTP plugin failed to download artifacts.")
+        return None
+    return resp.json()
+
+
+def load_honeypot_rules(honeypot_rules):
+    """
+    replace the responses and signatures with the downloaded ones
+    """
+    # Empty tables
+    settings.DATABASE_SESSION.query(SignatureResponse).delete()
+    settings.DATABASE_SESSION.query(Signature).delete()
+    settings.DATABASE_SESSION.query(Response).delete()
+
+    if honeypot_rules is None:
         return
 
     # Hydrate
     responses = []
-    for response in resp.json()["responses"]:
+    for response in honeypot_rules["responses"]:
         try:
             response_schema = schemas.Response(**response)
         except ValidationError as err:
@@ -172,7 +182,7 @@ def hydrate_tables():
     settings.DATABASE_SESSION.add_all(responses)
 
     signatures = []
-    for signature in resp.json()["signatures"]:
+    for signature in honeypot_rules["signatures"]:
         try:
             signature_schema = schemas.Signature(**signature)
         except ValidationError as err:
@@ -189,40 +199,56 @@ def hydrate_tables():
     settings.DATABASE_SESSION.flush()
 
 
+def hydrate_tables():
+    """
+    potentially insert data into the tables we just created
+    """
+    settings.DATABASE_SESSION.query(RequestLog).delete()
+    load_honeypot_rules(download_honeypot_rules())
+
+
 def prepare_database():
     create_tables()
     hydrate_tables()
 
-def read_db_and_log(file_name=""):
+def read_db_and_log(file_name="", request_logs=None):
     if file_name == '':
-        todaydate = datetime.datetime.today().strftime('%Y-%m-%d')
+        todaydate = datetime.date.today().isoformat()
         file_name = f"/srv/db/webhoneypot-{todaydate}.json";
+    if request_logs is None:
+        request_logs = settings.DATABASE_SESSION.query(RequestLog).order_by(RequestLog.id)
     logs = []
-    for instance in settings.DATABASE_SESSION.query(RequestLog).order_by(RequestLog.id):
-        signature = settings.DATABASE_SESSION.query(Signature).filter(Signature.id == instance.signature_id).first()
-        signature_rules = {"max_score": signature.max_score, "rules": signature.rules} if signature else None
-
-        resp = settings.DATABASE_SESSION.query(Response).filter(Response.id == instance.response_id).first()
-        resp_details = {"comment": resp.comment, "headers": resp.headers, "status_code": resp.status_code} if resp else None
-
-        try:
-            useragent = ast.literal_eval(instance.headers)['user-agent'],
-        except KeyError:
-            useragent = ''
-        log_data = {
-            'time': datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f"),
-            'headers': ast.literal_eval(instance.headers),
-            'sip': instance.client_ip,
-            'dip': instance.target_ip,
-            'method': instance.method,
-            'url': instance.path,
-            'data': instance.data,
-            'useragent': useragent,
-            'version': (instance.version).decode("utf-8"),
-            'response_id': resp_details,
-            'signature_id': signature_rules
-        }
-        with open(file_name, "a") as file:
+    with open(file_name, "a") as file:
+        for instance in request_logs:
+            signature = None
+            if instance.signature_id is not None:
+                signature = settings.DATABASE_SESSION.get(Signature, instance.signature_id)
+            signature_rules = {"max_score": signature.max_score, "rules": signature.rules} if signature else None
+
+            resp = None
+            if instance.response_id is not None:
+                resp = settings.DATABASE_SESSION.get(Response, instance.response_id)
+            resp_details = None
+            if resp:
+                resp_details = {"comment": resp.comment, "headers": resp.headers, "status_code": resp.status_code}
+
+            try:
+                useragent = ast.literal_eval(instance.headers)['user-agent'],
+            except KeyError:
+                useragent = ''
+            log_data = {
+                'time': instance.time.isoformat(timespec='microseconds'),
+                'headers': ast.literal_eval(instance.headers),
+                'sip': instance.client_ip,
+                'dip': instance.target_ip,
+                'method': instance.method,
+                'url': instance.path,
+                'data': instance.data,
+                'useragent': useragent,
+                'version': (instance.version).decode("utf-8"),
+                'response_id': resp_details,
+                'signature_id': signature_rules
+            }
             json.dump(log_data, file)
             file.write("\n")
     return logs
@@ -1,6 +1,6 @@
 import pytest
 
-from plugins.tcp.http import models
+from plugins.tcp.http import main, models
 
 from tests.plugins.tcp.http.model_factories import *
 
@@ -8,3 +8,9 @@ from tests.plugins.tcp.http.model_factories import *
 @pytest.fixture(scope='package', autouse=True)
 def create_tables():
     models.create_tables()
+
+
+@pytest.fixture(autouse=True)
+def reset_http_plugin():
+    main.reload_signatures()
+    main.pending_request_logs.clear()
@@ -1,10 +1,20 @@
+from io import BytesIO
 from unittest.mock import patch, call, MagicMock
 
-from twisted.internet import reactor
+from twisted.internet import defer, reactor
+from twisted.internet.interfaces import ITCPTransport
+from twisted.internet.testing import StringTransport
 from twisted.web.http import Request
+from twisted.web.server import Site
 from twisted.web.test.test_web import DummyRequest
+from zope.interface import implementer
 
-from plugins.tcp.http.main import HTTP, get_winning_signature, handler
+from plugins.tcp.http.main import (
+    HTTP, NoDelayFactory, compile_rules, default_listen_backlog, default_max_logged_body_size,
+    extract_request_attributes, flush_request_logs, get_signature_responses, get_template, get_winning_signature,
+    handler, log_request, pending_request_logs, read_request_body, render_bytes, render_headers, submit_logs
+)
+from plugins.tcp.http.models import RequestLog
 
 
 class EnhancedDummyRequest(DummyRequest, Request):
@@ -34,6 +44,33 @@ class TestHTTP:
         request.method = b'POST'
         self.http.render(request)
         assert request.responseCode == 200
+        assert request.finished
+
+    def test_post_data_is_logged(self):
+        request = EnhancedDummyRequest(b'/')
+        request.method = b'POST'
+        request.content = BytesIO(b'user=admin&pass=admin')
+        self.http.render(request)
+        assert pending_request_logs[-1].data == {'post_data': 'user=admin&pass=admin'}
+
+    def test_logged_post_data_respects_handler_limit(self):
+        request = EnhancedDummyRequest(b'/')
+        request.method = b'POST'
+        request.content = BytesIO(b'user=admin&pass=admin')
+        HTTP(max_logged_body_size=4).render(request)
+        assert pending_request_logs[-1].data == {'post_data': 'user'}
+
+    def test_response_headers_are_sent(self, signature_factory):
+        signature_factory(
+            responses__batch_size=1,
+            responses__headers={'Server': 'Apache', 'X-Path': '{{ path }}'},
+            rules=[{'attribute': 'method', 'value': 'GET', 'required': True, 'condition': 'equals', 'score': 1}]
+        )
+        request = EnhancedDummyRequest(b'/')
+        self.http.render(request)
+        assert request.responseHeaders.getRawHeaders(b'server') == [b'Apache']
+        assert request.responseHeaders.getRawHeaders(b'x-path') == [b'/']
+        assert request.responseHeaders.getRawHeaders(b'content-length') == [b'%d' % len(request.written[0])]
 
     def test_when_no_signature_matches(self):
         request = EnhancedDummyRequest(b'/')
@@ -94,6 +131,53 @@ class TestHTTP:
         get_winning_signature({})
         assert get_signature_score_mock.call_count == 3
 
+    @patch('plugins.tcp.http.main.get_signature_score')
+    def test_repeated_request_is_not_rescored(self, get_signature_score_mock, signature_factory):
+        signature_factory.create_batch(size=2, max_score=50)
+        get_signature_score_mock.return_value = 10
+        get_winning_signature({'method': 'GET', 'path': '/'})
+        get_winning_signature({'method': 'GET', 'path': '/'})
+        assert get_signature_score_mock.call_count == 2
+
+    @patch('plugins.tcp.http.main.get_signature_score')
+    def test_header_membership_rule_ignores_header_values(self, get_signature_score_mock, signature_factory):
+        rule = {'attribute': 'headers', 'value': 'x-scanner', 'required': False, 'condition': 'contains', 'score': 1}
+        signature_factory(rules=[rule])
+        get_signature_score_mock.return_value = 1
+        get_winning_signature({'headers': {'x-scanner': '1', 'user-agent': 'a'}})
+        get_winning_signature({'headers': {'x-scanner': '2', 'user-agent': 'b'}})
+        assert get_signature_score_mock.call_count == 1
+        get_winning_signature({'headers': {'user-agent': 'a'}})
+        assert get_signature_score_mock.call_count == 2
+
+    @patch('plugins.tcp.http.main.get_signature_score')
+    def test_signatures_requiring_another_method_are_not_scored(self, get_signature_score_mock, signature_factory):
+        rule = {'attribute': 'method', 'value': 'GET', 'required': True, 'condition': 'equals', 'score': 1}
+        signature_factory(rules=[rule])
+        get_signature_score_mock.return_value = 1
+        assert get_winning_signature({'method': 'POST'}) is None
+        assert not get_signature_score_mock.called
+        assert get_winning_signature({'method': 'GET'}) is not None
+
+    def test_required_method_rule_scores_without_being_evaluated(self, signature_factory):
+        rules = [
+            {'attribute': 'method', 'value': 'GET', 'required': True, 'condition': 'equals', 'score': 5},
+            {'attribute': 'path', 'value': '/admin', 'required': True, 'condition': 'equals', 'score': 1},
+        ]
+        signature = signature_factory(rules=rules)
+        assert get_winning_signature({'method': 'GET', 'path': '/'}) is None
+        with patch('plugins.tcp.http.main.get_signature_score', return_value=6) as get_signature_score_mock:
+            assert get_winning_signature({'method': 'GET', 'path': '/admin'}) == signature
+        path_rule, = get_signature_score_mock.call_args[0][0]
+        assert path_rule.attribute == 'path'
+        assert get_signature_score_mock.call_args[0][2] == 5
+
+    def test_signature_responses_are_plain_tuples(self, signature_factory):
+        signature = signature_factory(responses__batch_size=1, responses__headers={'Server': 'Apache'})
+        response, = get_signature_responses()[signature.id]
+        assert response.id == signature.responses[0].id
+        assert response.headers == (('Server', 'Apache'),)
+
     def test_invalid_attribute_in_rule(self, signature_factory):
         signature_factory(
             responses__batch_size=1,
@@ -149,7 +233,162 @@ class TestHTTP:
         assert request.responseCode == 200
 
 
+class TestExtractRequestAttributes:
+    def test_headers_are_lowercased_and_last_value_wins(self):
+        request = EnhancedDummyRequest(b'/')
+        request.requestHeaders.setRawHeaders(b'User-Agent', [b'first', b'second'])
+        assert extract_request_attributes(request)['headers'] == {'user-agent': 'second'}
+
+
+class TestReadRequestBody:
+    def test_body_is_capped(self):
+        request = EnhancedDummyRequest(b'/')
+        request.content = BytesIO(b'a' * (default_max_logged_body_size + 1))
+        assert len(read_request_body(request)) == default_max_logged_body_size
+
+    def test_cap_is_configurable(self):
+        request = EnhancedDummyRequest(b'/')
+        request.content = BytesIO(b'user=admin&pass=admin')
+        assert read_request_body(request, 4) == 'user'
+
+    def test_missing_body(self):
+        assert read_request_body(EnhancedDummyRequest(b'/')) == ''
+
+
+class TestGetTemplate:
+    def test_template_is_compiled_once(self):
+        assert get_template('{{ path }}') is get_template('{{ path }}')
+
+    def test_template_renders_variables(self):
+        assert get_template('Hello {{ path }}').render(path='/admin') == 'Hello /admin'
+
+
+class TestRenderBytes:
+    def test_static_text_is_returned_as_jinja_would(self):
+        assert render_bytes('<b>Hello</b>\n', {}) == b'<b>Hello</b>'
+
+    def test_variables_are_rendered(self):
+        assert render_bytes('{{ path }}', {'path': '/admin'}) == b'/admin'
+
+    def test_static_text_is_encoded_once(self):
+        assert render_bytes('<b>Hello</b>', {}) is render_bytes('<b>Hello</b>', {})
+
+    def test_headers_are_rendered_individually(self):
+        headers = render_headers((('Server', 'Apache'), ('Location', '{{ path }}')), {'path': '/a\\b"'})
+        assert headers == ((b'Server', b'Apache'), (b'Location', b'/a\\b&#34;'))
+
+    def test_static_headers_are_shared(self):
+        headers = (('Server', 'Apache'), ('Connection', 'close'))
+        assert render_headers(headers, {}) is render_headers(headers, {'path': '/'})
+
+
+class TestCompileRules:
+    def test_unknown_conditions_are_dropped(self):
+        rules = [{'attribute': 'method', 'value': 'GET', 'required': True, 'condition': 'closetoit', 'score': 1}]
+        assert compile_rules(rules) == ()
+
+    def test_nested_values_are_split_once(self):
+        rules = [{'attribute': 'headers', 'value': 'host:a:8080', 'required': False, 'condition': 'equals', 'score': 2}]
+        rule = compile_rules(rules)[0]
+        assert (rule.attribute, rule.key, rule.value) == ('headers', 'host', 'a:8080')
+        assert (rule.score, rule.required) == (2, False)
+
+    def test_regex_is_compiled(self):
+        rules = [{'attribute': 'path', 'value': '^/wp-', 'required': True, 'condition': 'regex', 'score': 1}]
+        rule = compile_rules(rules)[0]
+        assert rule.condition_function(rule.value, '/wp-login.php')
+        assert not rule.condition_function(rule.value, '/index.html')
+
+    def test_invalid_regex_never_matches(self):
+        rules = [{'attribute': 'path', 'value': '(', 'required': True, 'condition': 'regex', 'score': 1}]
+        rule = compile_rules(rules)[0]
+        assert not rule.condition_function(rule.value, '(')
+
+
+class TestLogRequest:
+    request_attributes = {
+        'client_ip': '127.0.0.1',
+        'headers': {},
+        'method': 'GET',
+        'path': '/',
+        'target_ip': '127.0.0.1',
+        'version': b'HTTP/1.1',
+    }
+
+    @patch('plugins.tcp.http.main.read_db_and_log')
+    def test_logging_does_not_write(self, read_db_and_log_mock, database_session):
+        for _ in range(100):
+            log_request(self.request_attributes)
+        assert database_session.query(RequestLog).count() == 0
+        assert not read_db_and_log_mock.called
+        assert len(pending_request_logs) == 100
+
+    @patch('plugins.tcp.http.main.read_db_and_log')
+    def test_flush_writes_pending_logs(self, read_db_and_log_mock, database_session):
+        log_request(self.request_attributes)
+        flush_request_logs()
+        flush_request_logs()
+        assert database_session.query(RequestLog).count() == 1
+        assert len(read_db_and_log_mock.call_args.kwargs['request_logs']) == 1
+        assert read_db_and_log_mock.call_count == 1
+
+
+class TestSubmitLogs:
+    @patch('plugins.tcp.http.main.download_honeypot_rules')
+    @patch('plugins.tcp.http.main.post_logs')
+    @patch('plugins.tcp.http.main.threads')
+    def test_submitted_logs_are_removed(self, threads_mock, post_logs_mock, download_mock, database_session,
+                                        request_log_factory):
+        threads_mock.deferToThread.side_effect = defer.maybeDeferred
+        download_mock.return_value = None
+        request_log_factory()
+        submit_logs()
+        assert len(post_logs_mock.call_args[0][0]) == 1
+        assert download_mock.called
+        assert database_session.query(RequestLog).count() == 0
+
+    @patch('plugins.tcp.http.main.download_honeypot_rules')
+    @patch('plugins.tcp.http.main.post_logs')
+    @patch('plugins.tcp.http.main.threads')
+    def test_rules_are_reloaded_when_nothing_to_submit(self, threads_mock, post_logs_mock, download_mock):
+        threads_mock.deferToThread.side_effect = defer.maybeDeferred
+        download_mock.return_value = None
+        submit_logs()
+        assert not post_logs_mock.called
+        assert download_mock.called
+
+
+@implementer(ITCPTransport)
+class TCPStringTransport(StringTransport):
+    no_delay = False
+
+    def setTcpNoDelay(self, enabled):
+        self.no_delay = enabled
+
+
+class TestNoDelayFactory:
+    def test_nagle_is_disabled(self):
+        transport = TCPStringTransport()
+        protocol = NoDelayFactory(Site(HTTP())).buildProtocol(None)
+        protocol.makeConnection(transport)
+        assert transport.no_delay
+
+    def test_requests_are_served_through_the_wrapper(self):
+        transport = TCPStringTransport()
+        protocol = NoDelayFactory(Site(HTTP())).buildProtocol(None)
+        protocol.makeConnection(transport)
+        protocol.dataReceived(b'GET / HTTP/1.0\r\n\r\n')
+        assert transport.value().startswith(b'HTTP/1.0 ')
+
+
 class TestHandler:
+    @patch('plugins.tcp.http.main.task')
+    @patch('plugins.tcp.http.main.prepare_database')
+    @patch('plugins.tcp.http.main.reactor')
+    def test_thread_pool_size_is_respected(self, reactor_mock, prepare_database_mock, task_mock):
+        handler(thread_pool_size=2)
+        reactor_mock.suggestThreadPoolSize.assert_called_once_with(2)
+
     @patch('plugins.tcp.http.main.ssl')
     def test_handler_does_not_start_https_if_no_certs(self, ssl_mock):
         handler()
@@ -172,7 +411,7 @@ class TestHandler:
         ssl_context_mock = MagicMock()
         ssl_mock.DefaultOpenSSLContextFactory.return_value = ssl_context_mock
         handler(http_ports=http_ports, https_ports=https_ports)
-        http_calls = [call(reactor, port) for port in http_ports]
-        https_calls = [call(reactor, port, ssl_context_mock) for port in https_ports]
+        http_calls = [call(reactor, port, backlog=default_listen_backlog) for port in http_ports]
+        https_calls = [call(reactor, port, ssl_context_mock, backlog=default_listen_backlog) for port in https_ports]
         endpoints_mock.TCP4ServerEndpoint.assert_has_calls(http_calls, any_order=True)
         endpoints_mock.SSL4ServerEndpoint.assert_has_calls(https_calls, any_order=True)
@@ -1,7 +1,8 @@
+import datetime
 import json
 from unittest.mock import patch, mock_open
 
-from plugins.tcp.http.models import prepare_database, Response, Signature
+from plugins.tcp.http.models import prepare_database, read_db_and_log, Response, Signature
 
 
 def test_request_log_printing(request_log_factory):
@@ -9,6 +10,14 @@ def test_request_log_printing(request_log_factory):
     assert str(request_log) == str(request_log.id)
 
 
+def test_logged_time_is_request_time(request_log_factory, tmp_path):
+    request_time = datetime.datetime(2022, 5, 1, 12, 30, 15, 250)
+    request_log = request_log_factory(time=request_time, headers="{'user-agent': 'curl'}", version=b'HTTP/1.1')
+    log_file = tmp_path / 'webhoneypot.json'
+    read_db_and_log(str(log_file), request_logs=[request_log])
+    assert json.loads(log_file.read_text())['time'] == '2022-05-01T12:30:15.000250'
+
+
 def test_response_printing(response_factory):
     response = response_factory.build()
     assert str(response) == str(response.id)